@@ -1,20 +1,35 @@
 # bot.py
 # Icsan Search Bot - versão final entregue
-# Requer: python-telegram-bot, fastapi, httpx, gunicorn, uvicorn
-# Env vars required: TELEGRAM_TOKEN, (optional) LOG_CHANNEL_ID, UPDATE_CHANNEL_ID, RENDER_EXTERNAL_URL
+# Requer: python-telegram-bot, fastapi, httpx[http2], gunicorn, uvicorn, orjson, redis
+# Env vars required: TELEGRAM_TOKEN, (optional) LOG_CHANNEL_ID, UPDATE_CHANNEL_ID, RENDER_EXTERNAL_URL, REDIS_URL, WEBHOOK_SECRET, LEGACY_WEBHOOK_ROUTE, LOG_LEVEL
 
 import os
 import io
 import re
-import time
 import json
+import codecs
+import time
+import hmac
+import hashlib
+import queue
+import threading
+import atexit
 import logging
 import asyncio
+import functools
+import contextlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 from typing import Any, Dict, List, Tuple, Optional
+from urllib.parse import quote, urlsplit
 
 import httpx
-from fastapi import FastAPI, Request
+import orjson
+import redis.asyncio
+from fastapi import FastAPI, Request, Response
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
     Application,
@@ -25,6 +40,11 @@ from telegram.ext import (
     filters,
 )
 
+try:
+    import uvloop
+except ImportError:  # uvloop não existe no Windows
+    uvloop = None
+
 # ---------------- Config ----------------
 BOT_DISPLAY_NAME = "Icsan Search Bot"
 BOT_USERNAME = "@IcsanSearchBot"
@@ -34,6 +54,13 @@ TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN", "SEU_TOKEN_AQUI")
 RAW_LOG_CHANNEL_ID = os.environ.get("LOG_CHANNEL_ID", "1003027034402")
 RAW_UPDATE_CHANNEL_ID = os.environ.get("UPDATE_CHANNEL_ID", "1003027034402")
 
+# Webhook em rota fixa; o Telegram se autentica pelo header de secret token.
+# Sem WEBHOOK_SECRET, deriva um valor estável do token (igual em todos os workers).
+WEBHOOK_PATH = "/tg"
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()
+# Rota antiga /<token> (sem secret_token): só sobe com LEGACY_WEBHOOK_ROUTE=1
+LEGACY_WEBHOOK_ROUTE = os.environ.get("LEGACY_WEBHOOK_ROUTE", "").lower() in ("1", "true", "yes")
+
 def normalize_chat_id(raw: str) -> int:
     try:
         r = raw.strip()
@@ -54,10 +81,43 @@ UPDATE_CHANNEL_ID = normalize_chat_id(RAW_UPDATE_CHANNEL_ID)
 HTTP_TIMEOUT = 20.0
 HTTP_RETRIES = 2
 HTTP_BACKOFF = [1, 2, 4]
+HTTP_MAX_CONNECTIONS = 200
+HTTP_MAX_KEEPALIVE = 50
+HTTP_KEEPALIVE_EXPIRY = 60.0
+HTTP_HOST_CONCURRENCY = 8
+HTTP_RETRY_AFTER_MAX = 10.0
+REPORT_WORKERS = 4
+MAX_INLINE_CHARS = 3000  # acima disso o resultado vai como .txt
+
+# Cache de resultados (opcional): sem REDIS_URL toda consulta vai direto à API
+REDIS_URL = os.environ.get("REDIS_URL")
+RESULT_CACHE_TTL = 3600
+# Redis lento não pode segurar a consulta: acima disso segue sem cache
+REDIS_TIMEOUT = 0.3
+CACHE_ERROR_LOG_INTERVAL = 60.0
+# Cache local (por worker) na frente do Redis
+LOCAL_CACHE_TTL = 300.0
+LOCAL_CACHE_MAX = 1024
 
 # ---------------- Logging ----------------
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Nível inválido faria o basicConfig levantar ValueError no import; cai para INFO
+_log_level = getattr(logging, LOG_LEVEL, None)
+_log_level_invalid = not isinstance(_log_level, int)
+if _log_level_invalid:
+    _log_level = logging.INFO
+# Handlers só enfileiram; a escrita em stderr fica numa thread à parte
+# para não bloquear o event loop
+LOG_QUEUE: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+LOG_LISTENER = QueueListener(LOG_QUEUE, _log_stream)
+logging.basicConfig(level=_log_level, handlers=[QueueHandler(LOG_QUEUE)])
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
 logger = logging.getLogger("icsan_bot")
+if _log_level_invalid:
+    logger.warning("LOG_LEVEL inválido (%r), usando INFO", LOG_LEVEL)
 
 # ---------------- API Endpoints ----------------
 API_ENDPOINTS: Dict[str, str] = {
@@ -84,10 +144,58 @@ API_ENDPOINTS: Dict[str, str] = {
     "mac_api":           "https://api.macvendors.com/{valor}",
 }
 
+@dataclass(frozen=True)
+class ApiSpec:
+    """Template pré-dividido em (prefixo, sufixo) para montar a URL sem str.format"""
+    prefix: str
+    suffix: str
+    ttl: int = RESULT_CACHE_TTL
+
+    def url(self, valor: str) -> str:
+        return self.prefix + quote(valor, safe="") + self.suffix
+
+# Dados cadastrais mudam pouco e ficam com RESULT_CACHE_TTL; só o que é volátil
+# (geolocalização de IP, que muda com a realocação de endereços) ganha TTL próprio
+API_TTL_OVERRIDES: Dict[str, int] = {
+    "ip_api": 600,
+}
+
+API_SPECS: Dict[str, ApiSpec] = {
+    key: ApiSpec(*tpl.split("{valor}", 1), ttl=API_TTL_OVERRIDES.get(key, RESULT_CACHE_TTL))
+    for key, tpl in API_ENDPOINTS.items()
+}
+
+def endpoint_url(key: str, valor: str) -> str:
+    return API_SPECS[key].url(valor)
+
 # ---------------- State ----------------
-API_STATUS: Dict[str, Dict[str, Any]] = {}
+API_STATUS_ICON: Dict[str, str] = {}
+API_STATUS_RT: Dict[str, Optional[float]] = {}
 LAST_EPHEMERAL: Dict[int, int] = {}
-HTTP_CLIENT = httpx.AsyncClient(timeout=HTTP_TIMEOUT)
+REPORT_EXECUTOR = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
+_MENU_CACHE: Dict[Tuple[Tuple[str, str], ...], InlineKeyboardMarkup] = {}
+INFLIGHT: Dict[str, "asyncio.Task[Any]"] = {}
+HOST_SEMAPHORES: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(HTTP_HOST_CONCURRENCY))
+LOCAL_CACHE: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()  # url -> (expira_em, dados)
+HTTP_CLIENT = httpx.AsyncClient(
+    timeout=HTTP_TIMEOUT,
+    trust_env=False,
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=1,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    ),
+)
+CACHE = redis.asyncio.from_url(
+    REDIS_URL,
+    decode_responses=False,
+    socket_timeout=REDIS_TIMEOUT,
+    socket_connect_timeout=REDIS_TIMEOUT,
+) if REDIS_URL else None
 
 FIELDS_TO_REMOVE = {"status", "message", "mensagem", "source", "token", "timestamp", "limit", "success", "code", "error"}
 PHRASES_TO_REMOVE = [
@@ -95,6 +203,7 @@ PHRASES_TO_REMOVE = [
     r"consulta\s+realizada\s+por", r"feito\s+por", r"criado\s+por",
     r"owner", r"created\s+by", r"consulted\s+by"
 ]
+_WS_RE = re.compile(r"\s+")
 
 # ---------------- Helpers ----------------
 def classify_rt(rt: Optional[float]) -> str:
@@ -106,22 +215,154 @@ def classify_rt(rt: Optional[float]) -> str:
         return "🟡"
     return "🔴"
 
-async def fetch_with_retries(url: str, retries: int = HTTP_RETRIES) -> Any:
+# Inteiros com 19+ dígitos podem passar de 64 bits; o orjson os converte em
+# float e corrompe números de protocolo/documento, então vão pelo json da stdlib
+_BIG_INT_RE = re.compile(rb"[\[:,]\s*-?\d{19,}")
+
+def json_loads(raw: bytes) -> Any:
+    """orjson no caminho comum; json da stdlib quando o orjson falha ou há inteiros grandes"""
+    if raw.startswith(codecs.BOM_UTF8):
+        raw = raw[len(codecs.BOM_UTF8):]
+    if _BIG_INT_RE.search(raw) is None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw)
+
+def json_dumps(data: Any) -> bytes:
+    try:
+        return orjson.dumps(data)
+    except orjson.JSONEncodeError:
+        # orjson recusa inteiros acima de 64 bits
+        return json.dumps(data, ensure_ascii=False).encode()
+
+_CACHE_ERROR_LOGGED_AT: List[float] = [0.0]
+
+def _log_cache_error(op: str, url: str, e: Exception):
+    # Avisa no máximo uma vez por intervalo para não inundar o log com o Redis fora
+    now = time.monotonic()
+    if now - _CACHE_ERROR_LOGGED_AT[0] >= CACHE_ERROR_LOG_INTERVAL:
+        _CACHE_ERROR_LOGGED_AT[0] = now
+        logger.warning("Cache %s failed for %s: %s", op, url, e)
+    else:
+        logger.debug("Cache %s failed for %s: %s", op, url, e)
+
+def _cache_key(url: str) -> bytes:
+    return b"api:" + hashlib.blake2b(url.encode(), digest_size=16).digest()
+
+async def fetch_with_retries(url: str, retries: int = HTTP_RETRIES, ttl: int = RESULT_CACHE_TTL) -> Any:
+    # Consultas simultâneas à mesma URL aguardam a requisição que já está em andamento.
+    # A busca roda numa task própria e cada chamador a aguarda via shield, então
+    # cancelar um chamador não cancela a busca nem os demais.
+    task = INFLIGHT.get(url)
+    if task is None:
+        task = asyncio.create_task(_fetch_cached(url, retries, ttl))
+        INFLIGHT[url] = task
+        task.add_done_callback(functools.partial(_inflight_done, url))
+    return await asyncio.shield(task)
+
+def _inflight_done(url: str, task: "asyncio.Task[Any]"):
+    if INFLIGHT.get(url) is task:
+        del INFLIGHT[url]
+    # Marca a exceção como lida caso todos os chamadores tenham sido cancelados
+    if not task.cancelled():
+        task.exception()
+
+def _local_cache_get(url: str) -> Any:
+    entry = LOCAL_CACHE.get(url)
+    if entry is None:
+        return None
+    expires, data = entry
+    if time.monotonic() >= expires:
+        del LOCAL_CACHE[url]
+        return None
+    LOCAL_CACHE.move_to_end(url)
+    return data
+
+def _local_cache_set(url: str, data: Any, ttl: float):
+    LOCAL_CACHE[url] = (time.monotonic() + min(ttl, LOCAL_CACHE_TTL), data)
+    LOCAL_CACHE.move_to_end(url)
+    while len(LOCAL_CACHE) > LOCAL_CACHE_MAX:
+        LOCAL_CACHE.popitem(last=False)
+
+_UPSTREAM_ERROR_STATUS = frozenset(("error", "erro", "fail", "failed"))
+
+def _is_cacheable(result: Any) -> bool:
+    """Só guarda respostas JSON de sucesso: nada de corpo não-JSON nem erro da API"""
+    if result is None:
+        return False
+    if not isinstance(result, dict):
+        return True
+    if "_raw" in result:
+        return False
+    if str(result.get("status", "")).lower() in _UPSTREAM_ERROR_STATUS:
+        return False
+    if result.get("success") is False or result.get("error"):
+        return False
+    return True
+
+async def _fetch_cached(url: str, retries: int, ttl: int) -> Any:
+    hit = _local_cache_get(url)
+    if hit is not None:
+        return hit
+
+    key = _cache_key(url) if CACHE is not None else None
+    if key is not None:
+        try:
+            raw = await CACHE.get(key)
+            if raw is not None:
+                data = json_loads(raw)
+                _local_cache_set(url, data, ttl)
+                return data
+        except Exception as e:
+            _log_cache_error("get", url, e)
+
+    result = await _fetch_with_retries(url, retries)
+    if not _is_cacheable(result):
+        return result
+
+    _local_cache_set(url, result, ttl)
+    if key is not None:
+        try:
+            await CACHE.set(key, json_dumps(result), ex=ttl)
+        except Exception as e:
+            _log_cache_error("set", url, e)
+    return result
+
+def _retry_after(r: httpx.Response) -> float:
+    try:
+        wait = float(r.headers.get("Retry-After", 1))
+    except ValueError:
+        wait = 1.0
+    return min(max(wait, 0.0), HTTP_RETRY_AFTER_MAX)
+
+async def _fetch_with_retries(url: str, retries: int) -> Any:
     last_exc = None
+    # Limita requisições simultâneas por host para não estourar o rate limit
+    sem = HOST_SEMAPHORES[urlsplit(url).netloc]
     for attempt in range(retries + 1):
         try:
-            r = await HTTP_CLIENT.get(url, timeout=HTTP_TIMEOUT)
+            async with sem:
+                r = await HTTP_CLIENT.get(url, timeout=HTTP_TIMEOUT)
             if r.status_code == 200:
                 try:
-                    return r.json()
-                except Exception:
+                    return json_loads(r.content)
+                except ValueError:
+                    pass
+                # Corpo em outro charset (ex.: latin-1 declarado no header)
+                try:
+                    return json.loads(r.text)
+                except ValueError:
                     return {"_raw": r.text}
             else:
                 last_exc = f"HTTP {r.status_code}"
+                if r.status_code == 429 and attempt < retries:
+                    await asyncio.sleep(_retry_after(r))
         except Exception as e:
             last_exc = e
             wait = HTTP_BACKOFF[min(attempt, len(HTTP_BACKOFF)-1)]
-            logger.warning(f"RequestException {e} for {url} (attempt {attempt+1}) - sleeping {wait}s")
+            logger.warning("RequestException %s for %s (attempt %s) - sleeping %ss", e, url, attempt + 1, wait)
             await asyncio.sleep(wait)
     return {"status": "ERROR", "message": f"Falha ao acessar API ({url}): {last_exc}"}
 
@@ -130,9 +371,18 @@ def remove_phrases(text: str) -> str:
         return text
     for phrase in PHRASES_TO_REMOVE:
         text = re.sub(phrase, "", text, flags=re.IGNORECASE)
-    # Remove espaços extras e limpa o texto
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
+    # Remove espaços extras e limpa o texto; só roda a regex se houver espaço
+    # duplo ou algum espaço especial (\t, \n, \xa0...), que não é imprimível
+    if "  " in text or not text.isprintable():
+        text = _WS_RE.sub(" ", text)
+    return text.strip()
+
+_EMPTY_VALUES = frozenset((None, "", "null", "None"))
+
+def _is_empty(v: Any) -> bool:
+    if isinstance(v, (dict, list)):
+        return not v
+    return v in _EMPTY_VALUES
 
 def clean_api_data(data: Any) -> Any:
     if isinstance(data, dict):
@@ -144,12 +394,7 @@ def clean_api_data(data: Any) -> Any:
             cleaned = clean_api_data(v)
             
             # Skip empty values
-            if cleaned is None: continue
-            if cleaned == "": continue
-            if cleaned == "null": continue
-            if cleaned == "None": continue
-            if cleaned == []: continue
-            if cleaned == {}: continue
+            if _is_empty(cleaned): continue
             
             # Remove phrases from string values
             if isinstance(cleaned, str):
@@ -161,22 +406,22 @@ def clean_api_data(data: Any) -> Any:
     
     if isinstance(data, list):
         cleaned_list = []
+        seen = set()
         for i in data:
             cleaned = clean_api_data(i)
-            if cleaned is None: continue
-            if cleaned == "": continue
-            if cleaned == "null": continue
-            if cleaned == "None": continue
-            if cleaned == []: continue
-            if cleaned == {}: continue
+            if _is_empty(cleaned): continue
             
             if isinstance(cleaned, str):
                 cleaned = remove_phrases(cleaned)
                 if not cleaned: continue
             
-            # Avoid duplicates
-            if cleaned not in cleaned_list:
-                cleaned_list.append(cleaned)
+            # Avoid duplicates: scalars via a set, dicts/lists by scanning the list
+            if isinstance(cleaned, (dict, list)):
+                if cleaned in cleaned_list: continue
+            else:
+                if cleaned in seen: continue
+                seen.add(cleaned)
+            cleaned_list.append(cleaned)
         return cleaned_list if cleaned_list else None
     
     if isinstance(data, str):
@@ -185,70 +430,150 @@ def clean_api_data(data: Any) -> Any:
     
     return data
 
+_INDENTS = tuple(" " * i for i in range(64))
+
+@functools.lru_cache(maxsize=4096)
+def key_title(k: str) -> str:
+    return k.replace("_", " ").title()
+
 def format_txt(data: Any, indent: int = 0) -> str:
     """Formata dados para arquivo .txt com recuos e organização"""
     lines: List[str] = []
-    pref = " " * indent
+    # DFS iterativa: (é_linha, linha ou nó, recuo)
+    stack: List[Tuple[bool, Any, int]] = [(False, data, indent)]
     
-    if isinstance(data, dict):
-        for k, v in data.items():
-            key = str(k).replace("_", " ").title()
-            if isinstance(v, (dict, list)):
-                lines.append(f"{pref}{key}:")
-                lines.append(format_txt(v, indent + 4))
-            else:
-                lines.append(f"{pref}{key}: {v}")
-        # Add blank line between major sections
-        if indent == 0 and lines:
-            lines.append("")
+    while stack:
+        is_line, node, ind = stack.pop()
+        if is_line:
+            lines.append(node)
+            continue
+        pref = _INDENTS[ind] if ind < len(_INDENTS) else " " * ind
+        
+        if isinstance(node, dict):
+            if not node:
+                lines.append("")
+                continue
+            todo: List[Tuple[bool, Any, int]] = []
+            for k, v in node.items():
+                key = key_title(str(k))
+                if isinstance(v, (dict, list)):
+                    todo.append((True, f"{pref}{key}:", 0))
+                    todo.append((False, v, ind + 4))
+                else:
+                    todo.append((True, f"{pref}{key}: {v}", 0))
+            stack.extend(reversed(todo))
             
-    elif isinstance(data, list):
-        for i, it in enumerate(data, 1):
-            lines.append(f"{pref}- Item {i}:")
-            lines.append(format_txt(it, indent + 2))
-        if indent == 0 and lines:
-            lines.append("")
-    else:
-        lines.append(f"{pref}{data}")
+        elif isinstance(node, list):
+            if not node:
+                lines.append("")
+                continue
+            todo = []
+            for i, it in enumerate(node, 1):
+                todo.append((True, f"{pref}- Item {i}:", 0))
+                todo.append((False, it, ind + 2))
+            stack.extend(reversed(todo))
+        else:
+            lines.append(f"{pref}{node}")
+    
+    # Add blank line between major sections
+    if indent == 0 and isinstance(data, (dict, list)) and data:
+        lines.append("")
         
     return "\n".join(lines)
 
-def format_html(data: Any, indent: int = 0) -> str:
-    """Formata dados para mensagens Telegram com HTML"""
+def format_html(data: Any, indent: int = 0, max_chars: Optional[int] = None) -> str:
+    """Formata dados para mensagens Telegram com HTML.
+
+    Com max_chars, para de formatar assim que o texto passa do limite; o
+    retorno então fica maior que max_chars e o chamador parte para o .txt.
+    """
     lines: List[str] = []
+    size = 0
+    # DFS iterativa: (é_linha, linha ou nó, recuo)
+    stack: List[Tuple[bool, Any, int]] = [(False, data, indent)]
     
-    if isinstance(data, dict):
-        for k, v in data.items():
-            key = str(k).replace("_", " ").title()
-            if isinstance(v, (dict, list)):
-                lines.append(f"<b>{key}:</b>")
-                lines.append(format_html(v, indent + 1))
-            else:
-                # Para valores simples, formata em uma linha
-                lines.append(f"<b>{key}:</b> {v}")
-        # Add blank line between major sections
-        if indent == 0 and lines:
-            lines.append("")
-            
-    elif isinstance(data, list):
-        for i, it in enumerate(data, 1):
-            lines.append(f"<b>• Item {i}:</b>")
-            lines.append(format_html(it, indent + 1))
-        if indent == 0 and lines:
-            lines.append("")
-    else:
-        lines.append(str(data))
+    while stack:
+        is_line, node, ind = stack.pop()
+        if is_line:
+            line = node
+        elif isinstance(node, dict):
+            if node:
+                todo: List[Tuple[bool, Any, int]] = []
+                for k, v in node.items():
+                    key = key_title(str(k))
+                    if isinstance(v, (dict, list)):
+                        todo.append((True, f"<b>{key}:</b>", 0))
+                        todo.append((False, v, ind + 1))
+                    else:
+                        # Para valores simples, formata em uma linha
+                        todo.append((True, f"<b>{key}:</b> {v}", 0))
+                stack.extend(reversed(todo))
+                continue
+            line = ""
+        elif isinstance(node, list):
+            if node:
+                todo = []
+                for i, it in enumerate(node, 1):
+                    todo.append((True, f"<b>• Item {i}:</b>", 0))
+                    todo.append((False, it, ind + 1))
+                stack.extend(reversed(todo))
+                continue
+            line = ""
+        else:
+            line = str(node)
+        
+        lines.append(line)
+        if max_chars is not None:
+            # size - 1 == tamanho do texto já unido com "\n"
+            size += len(line) + 1
+            if size - 1 > max_chars:
+                break
+    
+    # Add blank line between major sections
+    if indent == 0 and isinstance(data, (dict, list)) and data:
+        lines.append("")
         
     return "\n".join(lines)
 
+_DATE_CACHE: List[Any] = [0, ""]
+
+def utc_now_str() -> str:
+    """Data/hora UTC formatada, recalculada no máximo uma vez por segundo"""
+    t = int(time.time())
+    if t != _DATE_CACHE[0]:
+        _DATE_CACHE[:] = [t, time.strftime("%d/%m/%Y %H:%M:%S", time.gmtime(t))]
+    return _DATE_CACHE[1]
+
+_TXT_BODY_CACHE: Dict[bytes, str] = {}
+_TXT_BODY_CACHE_MAX = 64
+# generate_txt_bytes roda no REPORT_EXECUTOR, então o cache é compartilhado entre threads
+_TXT_BODY_LOCK = threading.Lock()
+
+def _txt_body(data: Any) -> str:
+    """Corpo do .txt, reaproveitado quando o mesmo resultado é exportado de novo"""
+    key = hashlib.blake2b(json_dumps(data), digest_size=16).digest()
+    with _TXT_BODY_LOCK:
+        body = _TXT_BODY_CACHE.get(key)
+    if body is not None:
+        return body
+
+    formatted = format_txt(clean_api_data(data))
+    if formatted and formatted.strip():
+        body = formatted
+    else:
+        body = "📭 Nenhum dado relevante encontrado na consulta."
+
+    with _TXT_BODY_LOCK:
+        if key not in _TXT_BODY_CACHE and len(_TXT_BODY_CACHE) >= _TXT_BODY_CACHE_MAX:
+            _TXT_BODY_CACHE.pop(next(iter(_TXT_BODY_CACHE)))
+        _TXT_BODY_CACHE[key] = body
+    return body
+
 def generate_txt_bytes(title: str, data: Any, username: str) -> bytes:
     """Gera arquivo .txt bem formatado"""
-    cleaned = clean_api_data(data)
-    formatted = format_txt(cleaned)
-    
     header = f"📊 RELATÓRIO DE CONSULTA — {title.upper()}\n"
     header += "=" * 60 + "\n"
-    header += f"📅 Data: {datetime.utcnow().strftime('%d/%m/%Y %H:%M:%S')} UTC\n"
+    header += f"📅 Data: {utc_now_str()} UTC\n"
     header += f"👤 Usuário: @{username if username else 'usuario'}\n"
     header += "=" * 60 + "\n\n"
     
@@ -257,30 +582,29 @@ def generate_txt_bytes(title: str, data: Any, username: str) -> bytes:
     footer += f"💬 Suporte: {SUPORTE_USERNAME}\n"
     footer += "=" * 60
     
-    if formatted and formatted.strip():
-        body = formatted
-    else:
-        body = "📭 Nenhum dado relevante encontrado na consulta."
-    
-    content = header + body + footer
+    content = header + _txt_body(data) + footer
     return content.encode("utf-8")
 
 # ---------------- Healthcheck ----------------
 async def check_api_health():
-    for key, template in API_ENDPOINTS.items():
+    for key in API_SPECS:
         test_val = "00000000000" if "cpf" in key else "TEST123"
-        url = template.format(valor=test_val)
+        url = endpoint_url(key, test_val)
         start = time.time()
         try:
             r = await HTTP_CLIENT.get(url, timeout=HTTP_TIMEOUT)
             rt = time.time() - start
             if r.status_code == 200:
-                API_STATUS[key] = {"icon": classify_rt(rt), "rt": rt}
+                API_STATUS_ICON[key] = classify_rt(rt)
+                API_STATUS_RT[key] = rt
             else:
-                API_STATUS[key] = {"icon": "🔴", "rt": None}
+                API_STATUS_ICON[key] = "🔴"
+                API_STATUS_RT[key] = None
         except Exception:
-            API_STATUS[key] = {"icon": "🔴", "rt": None}
-    logger.info(f"API_STATUS: {API_STATUS}")
+            API_STATUS_ICON[key] = "🔴"
+            API_STATUS_RT[key] = None
+    _MENU_CACHE.clear()
+    logger.info("API_STATUS: %s", API_STATUS_ICON)
 
 # ---------------- Telegram helpers ----------------
 def track_ephemeral(chat_id: int, message_id: int):
@@ -293,18 +617,20 @@ async def delete_ephemeral(app: Application, chat_id: int):
     try:
         await app.bot.delete_message(chat_id=chat_id, message_id=mid)
     except Exception as e:
-        logger.debug(f"Could not delete ephemeral {mid} in {chat_id}: {e}")
+        logger.debug("Could not delete ephemeral %s in %s: %s", mid, chat_id, e)
     LAST_EPHEMERAL.pop(chat_id, None)
 
 async def send_log(app: Application, text: str):
     try:
         await app.bot.send_message(chat_id=LOG_CHANNEL_ID, text=text)
     except Exception as e:
-        logger.warning(f"Failed to send log to {LOG_CHANNEL_ID}: {e}")
+        logger.warning("Failed to send log to %s: %s", LOG_CHANNEL_ID, e)
 
 # ---------------- Data detection ----------------
-def detect_type(s: str) -> str:
-    t = s.strip()
+_TYPE_CACHE: Dict[str, str] = {}
+_TYPE_CACHE_MAX = 128
+
+def _detect_type(t: str) -> str:
     if re.fullmatch(r"\d{11}", re.sub(r"\D", "", t)):
         return "cpf"
     if re.fullmatch(r"[A-Za-z]{3}\d{4}", t.replace("-","").upper()):
@@ -317,16 +643,53 @@ def detect_type(s: str) -> str:
         return "email"
     return ""
 
+def detect_type(s: str) -> str:
+    t = s.strip()
+    r = _TYPE_CACHE.get(t)
+    if r is not None:
+        return r
+    r = _detect_type(t)
+    if len(_TYPE_CACHE) >= _TYPE_CACHE_MAX:
+        _TYPE_CACHE.pop(next(iter(_TYPE_CACHE)))
+    _TYPE_CACHE[t] = r
+    return r
+
 # ---------------- Menu and callbacks ----------------
+# Teclados estáticos, montados uma única vez na importação
+MAIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔍 CPF", callback_data="menu_cpf")],
+    [InlineKeyboardButton("📂 CPF FULL", callback_data="menu_cpf_full")],
+    [InlineKeyboardButton("🚗 Veículo (placa/chassi/cnh)", callback_data="menu_veiculo")],
+    [InlineKeyboardButton("🌐 IP / MAC", callback_data="menu_net")],
+    [InlineKeyboardButton("💬 Suporte", url=f"https://t.me/{SUPORTE_USERNAME.replace('@','')}")],
+])
+
+VEICULO_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🚗 Placa", callback_data="menu_placa")],
+    [InlineKeyboardButton("📄 CNH", callback_data="menu_cnh")],
+    [InlineKeyboardButton("🔧 Chassi", callback_data="menu_chassi")],
+    [InlineKeyboardButton("⬅️ Voltar", callback_data="menu_back")]
+])
+
+NET_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🌐 IP", callback_data="menu_ip")],
+    [InlineKeyboardButton("📡 MAC", callback_data="menu_mac")],
+    [InlineKeyboardButton("⬅️ Voltar", callback_data="menu_back")]
+])
+
 def status_icon(key: str) -> str:
-    s = API_STATUS.get(key)
-    return s.get("icon", "🔴") if s else "🔴"
+    return API_STATUS_ICON.get(key, "🔴")
 
 def build_menu_buttons(options: List[Tuple[str,str]]):
-    kb = []
-    for label, key in options:
-        kb.append([InlineKeyboardButton(f"{status_icon(key)} {label}", callback_data=key)])
-    return InlineKeyboardMarkup(kb)
+    # Os ícones só mudam no healthcheck, que limpa este cache
+    cache_key = tuple(options)
+    markup = _MENU_CACHE.get(cache_key)
+    if markup is None:
+        kb = []
+        for label, key in options:
+            kb.append([InlineKeyboardButton(f"{status_icon(key)} {label}", callback_data=key)])
+        markup = _MENU_CACHE[cache_key] = InlineKeyboardMarkup(kb)
+    return markup
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -356,17 +719,6 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="HTML"
     )
     track_ephemeral(update.effective_chat.id, ep.message_id)
-    await asyncio.sleep(0.4)
-    
-    try:
-        await context.application.bot.edit_message_text(
-            chat_id=ep.chat_id, 
-            message_id=ep.message_id, 
-            text="📊 Processando...", 
-            parse_mode="HTML"
-        )
-    except Exception:
-        pass
 
     start = time.time()
     if api_key not in API_ENDPOINTS:
@@ -377,8 +729,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    url = API_ENDPOINTS[api_key].format(valor=query_value)
-    result = await fetch_with_retries(url)
+    spec = API_SPECS[api_key]
+    result = await fetch_with_retries(spec.url(query_value), ttl=spec.ttl)
     elapsed = time.time() - start
 
     if isinstance(result, dict) and result.get("status") == "ERROR":
@@ -395,10 +747,10 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     summary = f"✅ <b>Consulta concluída</b> — tempo: {elapsed:.2f}s\n\n"
 
     # ✅ CORREÇÃO: Formatação HTML para mensagens de texto
-    if cleaned and cleaned not in [None, {}, []]:
-        textified_html = format_html(cleaned)
+    if cleaned and not _is_empty(cleaned):
+        textified_html = format_html(cleaned, max_chars=MAX_INLINE_CHARS)
         
-        if textified_html and len(textified_html) <= 3000 and textified_html.strip():
+        if textified_html and len(textified_html) <= MAX_INLINE_CHARS and textified_html.strip():
             final_text = f"{summary}{textified_html}\n\n🤖 {BOT_DISPLAY_NAME}\n👤 @{username_for_file}"
             
             try:
@@ -431,7 +783,9 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 pass
             
             # ✅ CORREÇÃO: Formatação TXT para arquivos
-            txt_bytes = generate_txt_bytes(f"{api_key}_{query_value}", cleaned, username_for_file)
+            txt_bytes = await asyncio.get_running_loop().run_in_executor(
+                REPORT_EXECUTOR, generate_txt_bytes, f"{api_key}_{query_value}", cleaned, username_for_file
+            )
             bio = io.BytesIO(txt_bytes)
             bio.name = f"consulta_{api_key}_{query_value}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.txt"
             
@@ -488,14 +842,8 @@ async def handle_menu_navigation(update: Update, context: ContextTypes.DEFAULT_T
         await q.edit_message_text(text=text, parse_mode="HTML")
         
     elif menu_key == "menu_veiculo":
-        keyboard = [
-            [InlineKeyboardButton("🚗 Placa", callback_data="menu_placa")],
-            [InlineKeyboardButton("📄 CNH", callback_data="menu_cnh")],
-            [InlineKeyboardButton("🔧 Chassi", callback_data="menu_chassi")],
-            [InlineKeyboardButton("⬅️ Voltar", callback_data="menu_back")]
-        ]
         text = "🚗 <b>Consulta de Veículo</b>\n\nEscolha o tipo de consulta:"
-        await q.edit_message_text(text=text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(keyboard))
+        await q.edit_message_text(text=text, parse_mode="HTML", reply_markup=VEICULO_MENU_KB)
         
     elif menu_key == "menu_placa":
         text = "🚗 <b>Consulta de Placa</b>\n\nDigite a placa do veículo:"
@@ -513,13 +861,8 @@ async def handle_menu_navigation(update: Update, context: ContextTypes.DEFAULT_T
         await q.edit_message_text(text=text, parse_mode="HTML")
         
     elif menu_key == "menu_net":
-        keyboard = [
-            [InlineKeyboardButton("🌐 IP", callback_data="menu_ip")],
-            [InlineKeyboardButton("📡 MAC", callback_data="menu_mac")],
-            [InlineKeyboardButton("⬅️ Voltar", callback_data="menu_back")]
-        ]
         text = "🌐 <b>Consulta de Rede</b>\n\nEscolha o tipo de consulta:"
-        await q.edit_message_text(text=text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(keyboard))
+        await q.edit_message_text(text=text, parse_mode="HTML", reply_markup=NET_MENU_KB)
         
     elif menu_key == "menu_ip":
         text = "🌐 <b>Consulta de IP</b>\n\nDigite o endereço IP:"
@@ -535,13 +878,6 @@ async def handle_menu_navigation(update: Update, context: ContextTypes.DEFAULT_T
         await show_main_menu(update, context)
 
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("🔍 CPF", callback_data="menu_cpf")],
-        [InlineKeyboardButton("📂 CPF FULL", callback_data="menu_cpf_full")],
-        [InlineKeyboardButton("🚗 Veículo (placa/chassi/cnh)", callback_data="menu_veiculo")],
-        [InlineKeyboardButton("🌐 IP / MAC", callback_data="menu_net")],
-        [InlineKeyboardButton("💬 Suporte", url=f"https://t.me/{SUPORTE_USERNAME.replace('@','')}")],
-    ]
     text = (
         f"👋 <b>Bem-vindo ao {BOT_DISPLAY_NAME}</b>\n\n"
         "Use os comandos ou escolha uma opção abaixo.\n\n"
@@ -563,14 +899,14 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text(
             text=text, 
             parse_mode="HTML", 
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=MAIN_MENU_KB
         )
     else:
         await context.application.bot.send_message(
             chat_id=update.effective_chat.id,
             text=text,
             parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=MAIN_MENU_KB
         )
 
 # ... (o restante das funções permanece igual)
@@ -596,48 +932,86 @@ def register_handlers(app: Application):
     logger.info("Handlers registrados com sucesso.")
 
 # ---------------- FastAPI webhook for Render ----------------
-application = Application.builder().token(TELEGRAM_TOKEN).build()
+application = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(True).build()
 register_handlers(application)
 
-webhook_app = FastAPI()
-
-@webhook_app.on_event("startup")
-async def startup_event():
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    global CACHE
     logger.info("Startup: checking API health and initializing bot")
+    if CACHE is not None:
+        try:
+            await CACHE.ping()
+        except Exception as e:
+            logger.warning("Redis indisponível, seguindo sem cache: %s", e)
+            with contextlib.suppress(Exception):
+                await CACHE.aclose()
+            CACHE = None
+    # Também abre as conexões keep-alive com cada host antes do primeiro update
     await check_api_health()
     try:
         await application.initialize()
         await application.start()
+        await set_webhook_on_render(application, TELEGRAM_TOKEN)
         try:
             await application.bot.send_message(chat_id=UPDATE_CHANNEL_ID, text=f"{BOT_DISPLAY_NAME} iniciado em {datetime.utcnow().isoformat()} UTC")
         except Exception as e:
-            logger.warning(f"Announce update failed: {e}")
+            logger.warning("Announce update failed: %s", e)
         await send_log(application, f"{BOT_DISPLAY_NAME} iniciado em {datetime.utcnow().isoformat()} UTC")
         logger.info("Bot Telegram iniciado")
     except Exception as e:
-        logger.error(f"Erro ao iniciar bot: {e}")
+        logger.error("Erro ao iniciar bot: %s", e)
         await send_log(application, f"Erro ao iniciar bot: {e}")
 
-@webhook_app.post(f"/{TELEGRAM_TOKEN}")
-async def telegram_webhook(request: Request):
-    data = await request.json()
+    yield
+
+    if application.running:
+        await application.stop()
+    await application.shutdown()
+    await HTTP_CLIENT.aclose()
+    if CACHE is not None:
+        await CACHE.aclose()
+    REPORT_EXECUTOR.shutdown(wait=False)
+
+webhook_app = FastAPI(lifespan=lifespan)
+
+async def _process_webhook_body(request: Request):
+    data = orjson.loads(await request.body())
     update = Update.de_json(data, application.bot)
     await application.process_update(update)
     return {"ok": True}
 
+@webhook_app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    secret = request.headers.get("x-telegram-bot-api-secret-token", "")
+    if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        return Response(status_code=401)
+    return await _process_webhook_body(request)
+
+# Rota antiga (/<token>) para webhooks registrados antes da migração para WEBHOOK_PATH.
+# Não confere o secret_token, então fica desligada por padrão; ligue LEGACY_WEBHOOK_ROUTE
+# só durante a transição e desligue depois que set_webhook_on_render re-registrar o webhook
+if LEGACY_WEBHOOK_ROUTE:
+    @webhook_app.post(f"/{TELEGRAM_TOKEN}")
+    async def telegram_webhook_legacy(request: Request):
+        logger.warning("Update recebido na rota antiga do webhook; configure RENDER_EXTERNAL_URL para migrar para %s", WEBHOOK_PATH)
+        return await _process_webhook_body(request)
+
 async def set_webhook_on_render(application: Application, token: str):
     RENDER_EXTERNAL_URL = os.environ.get("RENDER_EXTERNAL_URL")
     if not RENDER_EXTERNAL_URL:
         logger.warning("RENDER_EXTERNAL_URL não configurada.")
         return
-    webhook_url = f"{RENDER_EXTERNAL_URL}/{token}"
+    webhook_url = f"{RENDER_EXTERNAL_URL}{WEBHOOK_PATH}"
     try:
         await application.bot.delete_webhook()
-        await application.bot.set_webhook(url=webhook_url)
-        logger.info(f"Webhook configurado: {webhook_url}")
+        await application.bot.set_webhook(url=webhook_url, secret_token=WEBHOOK_SECRET)
+        logger.info("Webhook configurado: %s", webhook_url)
     except Exception as e:
-        logger.warning(f"Failed to set webhook: {e}")
+        logger.warning("Failed to set webhook: %s", e)
 
 # ---------------- Local entrypoint (polling) ----------------
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     application.run_polling()